@@ -1,6 +1,10 @@
+import datetime
+import hashlib
 import os
+import secrets
 import time
 
+import orjson
 import requests
 from itsdangerous import URLSafeSerializer, BadSignature
 from flask import (
@@ -10,9 +14,13 @@ from flask import (
     url_for,
     request,
     flash,
-    jsonify,
+    session,
+    g,
 )
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import quote_etag
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from flask_login import (
     LoginManager,
     current_user,
@@ -22,6 +30,7 @@ from flask_login import (
 )
 from flask_s3 import FlaskS3
 from flask_assets import Environment, Bundle
+from flask_caching import Cache
 from playhouse.shortcuts import model_to_dict
 from zappa.async import task
 
@@ -34,6 +43,8 @@ from models import (
     IntegrityError,
     fn,
     JOIN,
+    Value,
+    prefetch,
 )
 from forms import (
     SignupForm,
@@ -56,24 +67,35 @@ app.config['FLASKS3_CDN_DOMAIN'] = os.environ.get('FLASKS3_CDN_DOMAIN')
 app.config['FLASKS3_BUCKET_NAME'] = os.environ.get('FLASKS3_BUCKET_NAME')
 app.config['FLASKS3_HEADERS'] = {'Cache-Control': 'max-age=31536000'}
 app.config['FLASKS3_GZIP'] = True
+app.config['FLASKS3_FORCE_MIMETYPE'] = True
 app.config['FLASK_ASSETS_USE_S3'] = True
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.config['CACHE_TYPE'] = os.environ.get('CACHE_TYPE', 'SimpleCache')
+app.config['CACHE_UWSGI_NAME'] = os.environ.get('CACHE_UWSGI_NAME', '')
+app.config['CACHE_DEFAULT_TIMEOUT'] = 300
 
 if os.environ.get('FLASK_DEBUG'):
     app.config['ASSETS_DEBUG'] = True
     app.config['FLASK_ASSETS_USE_S3'] = False
+    app.config['TEMPLATES_AUTO_RELOAD'] = True
+
+# Keep every compiled template; the template set is small and fixed.
+app.jinja_options = dict(Flask.jinja_options, cache_size=-1)
 
 s3 = FlaskS3(app)
 assets = Environment(app)
 assets.register(
     'css_all',
-    Bundle('main.css', output='main.%(version)s.css'),
+    Bundle('main.css', filters='cssmin', output='main.%(version)s.css'),
 )
+cache = Cache(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 @login_manager.user_loader
+@cache.memoize(timeout=60)
 def load_user(user_id):
     try:
         user = User.get(User.id == user_id)
@@ -85,6 +107,10 @@ def load_user(user_id):
 def _db_connect():
     db.connect(reuse_if_open=True)
 
+@app.before_request
+def _load_user_id():
+    g.user_id = current_user.get_id()
+
 @app.teardown_request
 def _db_close(exc):
     if not db.is_closed():
@@ -92,17 +118,78 @@ def _db_close(exc):
 
 cors_header = {'Access-Control-Allow-Origin': '*'}
 
+def json_response(data, status=200):
+    # API responses are encoded with orjson instead of Flask's json module.
+    # Memoized bodies are passed in already encoded.
+    if not isinstance(data, bytes):
+        data = orjson.dumps(data)
+    return app.response_class(
+        data,
+        status = status,
+        headers = cors_header,
+        mimetype = 'application/json',
+    )
+
+recovery_serializer = URLSafeSerializer(
+    app.config['SECRET_KEY'],
+    salt = 'password-recovery',
+)
+
+# API responses that only change when a quote or collection is written.
+cacheable_endpoints = {'collection_json', 'quote_json'}
+
+@app.after_request
+def _cache_headers(response):
+    if request.endpoint in cacheable_endpoints and response.status_code == 200:
+        response.cache_control.public = True
+        response.cache_control.max_age = 60
+        response.add_etag()
+        response = response.make_conditional(request)
+    return response
+
+password_hasher = PasswordHasher(
+    time_cost = 2,
+    memory_cost = 64 * 1024,
+    parallelism = 2,
+)
+# Hash of a discarded random password, made with the parameters above.
+# It is a literal so that importing the app does not pay for an argon2 hash.
+dummy_password_hash = (
+    '$argon2id$v=19$m=65536,t=2,p=2$9n5/dvqLpmHxT+EheY9kwg'
+    '$QD2zM6AqYCXgwh2SEsa7KjvgHYIBC5TcKg7XXXTMw60'
+)
+
+def check_password(user, password):
+    # Hashes from before the switch to argon2 are werkzeug pbkdf2 hashes.
+    # Those, and argon2 hashes with outdated parameters, are replaced on
+    # a successful login.
+    if user.password.startswith('$argon2'):
+        try:
+            password_hasher.verify(user.password, password)
+        except (VerificationError, InvalidHash):
+            return False
+        if not password_hasher.check_needs_rehash(user.password):
+            return True
+    elif not check_password_hash(user.password, password):
+        return False
+    user.password = password_hasher.hash(password)
+    user.save()
+    cache.delete_memoized(load_user, user.id)
+    return True
+
+# Reused across warm invocations so the TLS connection to Mailgun is kept.
+mailgun_session = requests.Session()
+
 @task
 def send_email(domain, key, data):
-    requests.post(
+    mailgun_session.post(
         f"https://api.mailgun.net/v3/{domain}/messages",
         auth = ('api', key),
         data = data,
     )
 
 def send_recovery_email(email):
-    s = URLSafeSerializer(app.config['SECRET_KEY'])
-    token = s.dumps({
+    token = recovery_serializer.dumps({
         'time': int(time.time()),
         'email': email,
     })
@@ -118,9 +205,166 @@ def send_recovery_email(email):
         data = email_data,
     )
 
+def add_quote_to_collections(quote, collection_names):
+    if not collection_names:
+        return
+    # Collection choices are cached, so a name may refer to a collection
+    # that has since been deleted. Only link the ones that still exist.
+    QuoteCollection.insert_from(
+        Collection.select(Value(quote.id), Collection.id).where(
+            Collection.name.in_(collection_names),
+            Collection.user == quote.user_id,
+        ),
+        [QuoteCollection.quote, QuoteCollection.collection],
+    ).on_conflict_ignore().execute()
+
+@cache.memoize(timeout=60)
+def collection_choices(user_id):
+    return [
+        (collection.name, collection.name)
+        for collection in Collection.select().where(
+            Collection.user == user_id,
+        )
+    ]
+
+def api_collection(user_id, collection_name):
+    if user_id is None:
+        # Collection names used to be unique across users. API URLs without
+        # a user id only resolve to the collection that owned the name then.
+        return Collection.select(Collection.id).where(
+            Collection.legacy_name == collection_name,
+        )
+    return Collection.select(Collection.id).where(
+        Collection.name == collection_name,
+        Collection.user == user_id,
+    )
+
+@cache.memoize()
+def collection_json_body(user_id, collection_name):
+    collection = api_collection(user_id, collection_name).first()
+    if collection is None:
+        return None
+    quotes = (
+        Quote.select(
+            Quote.content,
+            Quote.author,
+            Quote.id,
+        )
+        .join(QuoteCollection)
+        .where(
+            QuoteCollection.collection == collection,
+        )
+    )
+    return orjson.dumps({'quotes': list(quotes.dicts().iterator())})
+
+def collection_quotes(user_id, collection_name):
+    return (
+        Quote.select()
+        .join(QuoteCollection)
+        .where(
+            QuoteCollection.collection == api_collection(
+                user_id,
+                collection_name,
+            ),
+        )
+    )
+
+@cache.memoize(timeout=60)
+def collection_quote_count(user_id, collection_name):
+    return collection_quotes(user_id, collection_name).count()
+
+def random_collection_quote(user_id, collection_name):
+    quote_count = collection_quote_count(user_id, collection_name)
+    if not quote_count:
+        return None
+    quote = (
+        collection_quotes(user_id, collection_name)
+        .offset(secrets.randbelow(quote_count))
+        .first()
+    )
+    if quote is None:
+        # The cached count is stale and the collection has shrunk.
+        cache.delete_memoized(collection_quote_count, user_id, collection_name)
+        return random_collection_quote(user_id, collection_name)
+    return quote
+
+@cache.memoize()
+def quote_json_body(quote_id):
+    try:
+        quote = Quote.get(Quote.id == quote_id)
+    except Quote.DoesNotExist:
+        return None
+    return orjson.dumps(model_to_dict(
+        quote,
+        recurse=False,
+        exclude=[Quote.user],
+    ))
+
+def forget_collections(user_id, collection_names):
+    for collection_name in collection_names:
+        for api_user_id in (user_id, None):
+            cache.delete_memoized(
+                collection_json_body,
+                api_user_id,
+                collection_name,
+            )
+            cache.delete_memoized(
+                collection_quote_count,
+                api_user_id,
+                collection_name,
+            )
+
+def collections_changed(user_id, collection_names):
+    if not collection_names:
+        return
+    Collection.update(updated_at=datetime.datetime.utcnow()).where(
+        Collection.name.in_(collection_names),
+        Collection.user == user_id,
+    ).execute()
+    forget_collections(user_id, collection_names)
+
+app_started = datetime.datetime.utcnow()
+
+def csrf_epoch():
+    # Pages with a form embed a CSRF token that expires. Treat them as
+    # modified halfway through the token lifetime so a cached copy never
+    # carries a token that is about to expire.
+    period = (app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) // 2
+    now = int(time.time())
+    return datetime.datetime.utcfromtimestamp(now - now % period)
+
+def page_etag(*versions):
+    # A strong validator built from the full precision timestamps a page
+    # depends on, so a write in the same second as a render still shows.
+    return hashlib.sha1(
+        ' '.join(version.isoformat() for version in versions).encode(),
+    ).hexdigest()
+
+def not_modified(etag):
+    # Flashed messages are rendered into the page, so a cached copy is
+    # never current while some are waiting.
+    return (
+        request.method == 'GET'
+        and '_flashes' not in session
+        and etag in request.if_none_match
+    )
+
+def page_headers(etag):
+    # Pages differ between logged in users and can change without the
+    # session cookie changing, so browsers must revalidate every view and
+    # shared caches must not store them.
+    return {
+        'ETag': quote_etag(etag),
+        'Cache-Control': 'private, no-cache',
+        'Vary': 'Cookie',
+    }
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    etag = page_etag(app_started)
+    if not_modified(etag):
+        return '', 304, page_headers(etag)
+    return render_template('index.html'), page_headers(etag)
 
 @app.route('/signup', methods=['GET', 'POST'])
 def signup():
@@ -130,7 +374,7 @@ def signup():
             try:
                 User.create(
                     email = form.email.data,
-                    password = generate_password_hash(form.password.data),
+                    password = password_hasher.hash(form.password.data),
                 )
             except IntegrityError:
                 flash('An account with that email already exists.')
@@ -147,9 +391,15 @@ def login():
         try:
             user = User.get(User.email == form.email.data)
         except User.DoesNotExist:
+            # Hash anyway, so an unknown email takes as long as a wrong
+            # password.
+            try:
+                password_hasher.verify(dummy_password_hash, form.password.data)
+            except VerificationError:
+                pass
             flash('Incorrect email or password.')
             return redirect(url_for('login'))
-        if check_password_hash(user.password, form.password.data):
+        if check_password(user, form.password.data):
             login_user(user)
             return redirect(url_for('index'))
         else:
@@ -175,9 +425,8 @@ def forgot():
 
 @app.route('/recover-password/<token>', methods=['GET', 'POST'])
 def recover_password(token):
-    s = URLSafeSerializer(app.config['SECRET_KEY'])
     try:
-        token_data = s.loads(token)
+        token_data = recovery_serializer.loads(token)
     except BadSignature:
         flash('Failed to validate token.')
         return redirect(url_for('index'))
@@ -191,8 +440,9 @@ def recover_password(token):
         except User.DoesNotExist:
             flash('That user does not exist.')
             return redirect(url_for('index'))
-        user.password = generate_password_hash(form.password.data)
+        user.password = password_hasher.hash(form.password.data)
         user.save()
+        cache.delete_memoized(load_user, user.id)
         flash('Your password has been updated.')
         return redirect(url_for('login'))
     else:
@@ -213,82 +463,95 @@ def logout():
 @login_required
 def quotes():
     form = QuoteAddForm()
-    form.collections.choices = [
-        (collection.name, collection.name)
-        for collection in Collection.select().where(
-            Collection.user == current_user.get_id()
-        )
-    ]
+    form.collections.choices = collection_choices(g.user_id)
     if form.validate_on_submit():
         with db.atomic() as txn:
             quote = Quote.create(
                 content = form.content.data,
                 author = form.author.data,
-                user = current_user.get_id(),
+                user = g.user_id,
             )
-            for collection_name in form.collections.data:
-                collection = Collection.get(
-                    Collection.name == collection_name,
-                    Collection.user == current_user.get_id(),
-                )
-                QuoteCollection.create(
-                    quote = quote,
-                    collection = collection,
-                )
+            add_quote_to_collections(quote, form.collections.data)
+        collections_changed(g.user_id, form.collections.data)
         return redirect(url_for('quotes'))
     else:
-        quotes = Quote.select().where(Quote.user == current_user.get_id())
+        quotes = prefetch(
+            # The listing shows at most 200 characters of each quote.
+            Quote.select(
+                Quote.id,
+                fn.LEFT(Quote.content, 201).alias('content'),
+                Quote.author,
+            ).where(Quote.user == g.user_id),
+            QuoteCollection.select(),
+            Collection.select(Collection.id, Collection.name),
+        )
         return render_template('quotes.html', form=form, quotes=quotes)
 
 @app.route('/quotes/<quote_id>', methods=['GET', 'POST'])
 @login_required
 def quote(quote_id):
     try:
-        quote = Quote.get(
-            Quote.id == quote_id,
-            Quote.user == current_user.get_id(),
+        quote = (
+            Quote.select(
+                Quote,
+                fn.array_remove(
+                    fn.array_agg(Collection.name),
+                    None,
+                ).alias('collection_names'),
+            )
+            .join(QuoteCollection, JOIN.LEFT_OUTER)
+            .join(Collection, JOIN.LEFT_OUTER)
+            .where(
+                Quote.id == quote_id,
+                Quote.user == g.user_id,
+            )
+            .group_by(Quote.id)
+            .get()
         )
     except Quote.DoesNotExist:
         flash('Quote not found')
         return redirect(url_for('quotes'))
-    quote_collections = [
-        collection.name
-        for collection in Collection.select().join(QuoteCollection).where(
-            QuoteCollection.quote == quote,
-        )
-    ]
+    quote_collections = set(quote.collection_names)
     quote.collections = quote_collections
     form = QuoteEditForm(obj=quote)
-    form.collections.choices = [
-        (collection.name, collection.name)
-        for collection in Collection.select().where(
-            Collection.user == current_user.get_id()
-        )
-    ]
+    form.collections.choices = collection_choices(g.user_id)
     if form.validate_on_submit():
         if form.id.data != quote_id:
             flash('Quote ID mismatch!')
             return redirect(url_for('quotes'))
         if form.form_delete.data:
-            quote.delete_instance(recursive=True)
+            quote.delete_instance()
+            collections_changed(g.user_id, quote_collections)
+            cache.delete_memoized(quote_json_body, quote_id)
             flash('Quote deleted.')
             return redirect(url_for('quotes'))
         quote.content = form.content.data
         quote.author = form.author.data
         quote.save()
-        if set(quote_collections) != set(form.collections.data):
+        new_collections = set(form.collections.data)
+        if quote_collections != new_collections:
             flash('Collections updated.')
-            QuoteCollection.delete().where(
-                QuoteCollection.quote == quote,
-            ).execute()
+            removed_collections = quote_collections - new_collections
             with db.atomic() as txn:
-                for collection_name in form.collections.data:
-                    QuoteCollection.create(
-                        quote = quote,
-                        collection = Collection.get(
-                            Collection.name == collection_name,
+                if removed_collections:
+                    QuoteCollection.delete().where(
+                        QuoteCollection.quote == quote,
+                        QuoteCollection.collection.in_(
+                            Collection.select(Collection.id).where(
+                                Collection.name.in_(removed_collections),
+                                Collection.user == g.user_id,
+                            )
                         ),
-                    )
+                    ).execute()
+                add_quote_to_collections(
+                    quote,
+                    new_collections - quote_collections,
+                )
+        collections_changed(
+            g.user_id,
+            quote_collections | new_collections,
+        )
+        cache.delete_memoized(quote_json_body, quote_id)
         flash('Quote updated.')
         return redirect(url_for('quotes'))
     else:
@@ -303,21 +566,22 @@ def collections():
             try:
                 Collection.create(
                     name = form.name.data,
-                    user = current_user.get_id(),
+                    user = g.user_id,
                 )
             except IntegrityError:
                 flash('A collection with that name already exists.')
+        cache.delete_memoized(collection_choices, g.user_id)
         return redirect(url_for('collections'))
     else:
         collections = (
             Collection.select(
-                Collection,
+                Collection.name,
                 fn.COUNT(QuoteCollection.id).alias('quote_count'),
             )
             .join(QuoteCollection, JOIN.LEFT_OUTER)
-            .group_by(Collection)
+            .group_by(Collection.id)
             .where(
-                Collection.user == current_user.get_id(),
+                Collection.user == g.user_id,
             )
         )
         return render_template(
@@ -330,90 +594,89 @@ def collections():
 @login_required
 def collection(collection_name):
     try:
-        collection = (
-            Collection.select(Collection, Quote)
-            .join(QuoteCollection, JOIN.LEFT_OUTER)
-            .join(Quote, JOIN.LEFT_OUTER)
-            .where(
-                Collection.name == collection_name,
-                Collection.user == current_user.get_id(),
-            )
-            .get()
+        collection = Collection.get(
+            Collection.name == collection_name,
+            Collection.user == g.user_id,
         )
     except Collection.DoesNotExist:
         flash('Collection not found')
         return redirect(url_for('collections'))
+    etag = page_etag(app_started, csrf_epoch(), collection.updated_at)
+    if not_modified(etag):
+        return '', 304, page_headers(etag)
     form = CollectionEditForm(obj=collection)
     if form.validate_on_submit():
         if form.form_delete.data:
-            collection.delete_instance(recursive=True)
+            collection.delete_instance()
+            forget_collections(g.user_id, [collection_name])
+            cache.delete_memoized(collection_choices, g.user_id)
             flash('Collection deleted.')
             return redirect(url_for('collections'))
         collection.name = form.name.data
+        if collection.name != collection_name:
+            # A renamed collection gives up its name-only API URL.
+            collection.legacy_name = None
+        collection.updated_at = datetime.datetime.utcnow()
         try:
             collection.save()
         except IntegrityError:
             flash('A collection with that name already exists.')
             return redirect(url_for('collections'))
+        forget_collections(g.user_id, [collection_name, collection.name])
+        cache.delete_memoized(collection_choices, g.user_id)
         flash('Collection updated.')
         return redirect(url_for('collections'))
     else:
+        quotes = (
+            Quote.select(
+                Quote.id,
+                Quote.content,
+                Quote.author,
+            )
+            .join(QuoteCollection)
+            .where(
+                QuoteCollection.collection == collection,
+            )
+        )
         return render_template(
             'collection.html',
             form = form,
             collection = collection,
-        )
+            quotes = quotes,
+        ), page_headers(etag)
 
-@app.route('/api/collection/<collection_name>')
-def collection_json(collection_name):
-    try:
-        collection = Collection.get(Collection.name == collection_name)
-    except Collection.DoesNotExist:
-        return jsonify({'message': 'Collection not found.'}), 404, cors_header
-    quotes = (
-        Quote.select(
-            Quote.content,
-            Quote.author,
-            Quote.id,
-        )
-        .join(QuoteCollection)
-        .where(
-            QuoteCollection.collection == collection,
-        )
-    )
-    return jsonify({'quotes': list(quotes.dicts())}), cors_header
+@app.route('/api/user/<user_id>/collection/<collection_name>')
+@app.route(
+    '/api/collection/<collection_name>',
+    defaults = {'user_id': None},
+)
+def collection_json(user_id, collection_name):
+    body = collection_json_body(user_id, collection_name)
+    if body is None:
+        return json_response({'message': 'Collection not found.'}, 404)
+    return json_response(body)
 
-@app.route('/api/collection/<collection_name>/random')
-def collection_random_json(collection_name):
-    try:
-        quote = (
-            Quote.select()
-            .join(QuoteCollection)
-            .join(Collection)
-            .where(
-                Collection.name == collection_name,
-            )
-            .order_by(fn.Random())
-            .get()
+@app.route('/api/user/<user_id>/collection/<collection_name>/random')
+@app.route(
+    '/api/collection/<collection_name>/random',
+    defaults = {'user_id': None},
+)
+def collection_random_json(user_id, collection_name):
+    quote = random_collection_quote(user_id, collection_name)
+    if quote is None:
+        return json_response(
+            {'message': 'There are no quotes in that collection.'},
+            404,
         )
-    except Quote.DoesNotExist:
-        return jsonify(
-            {'message': 'There are no quotes in that collection.'}
-        ), 404, cors_header
-    return jsonify(model_to_dict(
+    return json_response(model_to_dict(
         quote,
         recurse = False,
         exclude = [Quote.user],
-    )), cors_header
+    ))
 
 @app.route('/api/quote/<quote_id>')
 def quote_json(quote_id):
-    try:
-        quote = Quote.get(Quote.id == quote_id)
-    except Quote.DoesNotExist:
-        return jsonify({'message': 'Quote not found.'}), 404, cors_header
-    return jsonify(model_to_dict(
-        quote,
-        recurse=False,
-        exclude=[Quote.user],
-    )), cors_header
+    body = quote_json_body(quote_id)
+    if body is None:
+        return json_response({'message': 'Quote not found.'}, 404)
+    return json_response(body)
@@ -1,3 +1,5 @@
+import string
+
 from flask_wtf import FlaskForm
 from wtforms import (
     StringField,
@@ -7,7 +9,13 @@ from wtforms import (
     BooleanField,
     SelectMultipleField,
 )
-from wtforms.validators import InputRequired, Email, Length, Regexp
+from wtforms.validators import InputRequired, Email, Length, ValidationError
+
+collection_name_chars = frozenset(string.ascii_letters + string.digits + '_-')
+
+def collection_name_allowed(form, field):
+    if not collection_name_chars.issuperset(field.data):
+        raise ValidationError('Allowed characters: A-Z a-z 0-9 _ -')
 
 class SignupForm(FlaskForm):
     email = StringField(
@@ -56,10 +64,7 @@ class CollectionAddForm(FlaskForm):
         [
             InputRequired(),
             Length(min=1, max=255),
-            Regexp(
-                '^[a-zA-Z0-9_-]*$',
-                message = 'Allowed characters: A-Z a-z 0-9 _ -',
-            ),
+            collection_name_allowed,
         ],
     )
 
@@ -1,7 +1,84 @@
+import datetime
+
+from peewee import CharField, DateTimeField
+from playhouse.migrate import PostgresqlMigrator, migrate as run_migrations
+
 import models
 
+def execute_concurrently(*statements):
+    # CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction.
+    connection = models.db.connection()
+    connection.commit()
+    connection.autocommit = True
+    try:
+        for statement in statements:
+            models.db.execute_sql(statement)
+    finally:
+        connection.autocommit = False
+
+def upgrade():
+    migrator = PostgresqlMigrator(models.db)
+    collection_columns = [
+        column.name for column in models.db.get_columns('collection')
+    ]
+    if 'updated_at' not in collection_columns:
+        run_migrations(migrator.add_column(
+            'collection',
+            'updated_at',
+            DateTimeField(default=datetime.datetime.utcnow),
+        ))
+    if 'legacy_name' not in collection_columns:
+        run_migrations(migrator.add_column(
+            'collection',
+            'legacy_name',
+            CharField(max_length=255, null=True),
+        ))
+        # Before names became per user, each one belonged to a single
+        # collection. If duplicates already exist, the oldest one kept the
+        # name-only API URL.
+        models.db.execute_sql(
+            'UPDATE collection SET legacy_name = name '
+            'WHERE id IN (SELECT MIN(id) FROM collection GROUP BY name)'
+        )
+    cascading_constraints = [
+        row[0] for row in models.db.execute_sql(
+            "SELECT conname FROM pg_constraint "
+            "WHERE conrelid = 'quotecollection'::regclass "
+            "AND contype = 'f' AND confdeltype = 'c'"
+        )
+    ]
+    for column, rel in (('quote_id', 'quote'), ('collection_id', 'collection')):
+        constraint = f'quotecollection_{column}_fkey'
+        if constraint not in cascading_constraints:
+            models.db.execute_sql(
+                f'ALTER TABLE quotecollection '
+                f'DROP CONSTRAINT IF EXISTS {constraint}, '
+                f'ADD CONSTRAINT {constraint} FOREIGN KEY ({column}) '
+                f'REFERENCES {rel} (id) ON DELETE CASCADE'
+            )
+    # Collection names are unique per user, and the composite indexes
+    # replace the single column foreign key indexes.
+    execute_concurrently(
+        'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS '
+        'quotecollection_collection_id_quote_id '
+        'ON quotecollection (collection_id, quote_id)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS quote_user_id_id '
+        'ON quote (user_id, id)',
+        'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS collection_user_id_name '
+        'ON collection (user_id, name)',
+        'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS collection_legacy_name '
+        'ON collection (legacy_name)',
+        'DROP INDEX CONCURRENTLY IF EXISTS collection_name',
+        'DROP INDEX CONCURRENTLY IF EXISTS collection_user_id',
+        'DROP INDEX CONCURRENTLY IF EXISTS quote_user_id',
+        'DROP INDEX CONCURRENTLY IF EXISTS quotecollection_quote_id',
+        'DROP INDEX CONCURRENTLY IF EXISTS quotecollection_collection_id',
+    )
+
 def migrate():
     models.db.connect()
+    if models.db.table_exists('collection'):
+        upgrade()
     models.db.create_tables([
         models.User,
         models.Quote,
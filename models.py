@@ -1,16 +1,37 @@
+import datetime
 import os
 import secrets
+import time
 
 from peewee import *
+from playhouse.pool import PooledPostgresqlDatabase
+
+crockford_base32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
 
 def gen_id():
-    return secrets.token_urlsafe(8)
+    # A ULID: a 48 bit millisecond timestamp followed by 80 random bits, in
+    # Crockford base32. Ids sort by creation time, so new rows are appended
+    # to the end of the primary key index instead of landing on random pages.
+    value = int(time.time() * 1000) << 80 | secrets.randbits(80)
+    return ''.join(
+        crockford_base32[value >> shift & 31]
+        for shift in range(125, -1, -5)
+    )
+
+# A Lambda container handles one request at a time, so it only ever needs
+# one pooled connection, which it keeps across warm invocations.
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    default_pool_size = 1
+else:
+    default_pool_size = 20
 
-db = PostgresqlDatabase(
+db = PooledPostgresqlDatabase(
     os.environ.get('PG_NAME', 'quote_generator'),
     host = os.environ.get('PG_HOST', 'localhost'),
     user = os.environ.get('PG_USER', 'postgres'),
     password = os.environ.get('PG_PASSWORD', 'postgres'),
+    max_connections = int(os.environ.get('PG_POOL_SIZE', default_pool_size)),
+    stale_timeout = int(os.environ.get('PG_STALE_TIMEOUT', 300)),
 )
 
 class BaseModel(Model):
@@ -38,17 +59,32 @@ class Quote(BaseModel):
     id = CharField(primary_key=True, default=gen_id)
     content = TextField(default='')
     author = CharField(max_length=255, default='')
-    user = ForeignKeyField(User)
+    user = ForeignKeyField(User, index=False)
+
+    class Meta:
+        indexes = (
+            (('user', 'id'), False),
+        )
 
 class Collection(BaseModel):
-    name = CharField(max_length=255, unique=True)
-    user = ForeignKeyField(User)
+    name = CharField(max_length=255)
+    user = ForeignKeyField(User, index=False)
+    # Set on the collection that owned the name back when names were unique
+    # across users. API URLs without a user id resolve through it.
+    legacy_name = CharField(max_length=255, null=True, unique=True)
+    updated_at = DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        indexes = (
+            (('user', 'name'), True),
+        )
 
 class QuoteCollection(BaseModel):
-    quote = ForeignKeyField(Quote)
-    collection = ForeignKeyField(Collection)
+    quote = ForeignKeyField(Quote, on_delete='CASCADE', index=False)
+    collection = ForeignKeyField(Collection, on_delete='CASCADE', index=False)
 
     class Meta:
         indexes = (
             (('quote', 'collection'), True),
+            (('collection', 'quote'), True),
         )